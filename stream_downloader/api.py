@@ -0,0 +1,197 @@
+import asyncio
+from abc import ABC, abstractmethod
+from pathlib import Path
+from threading import Event, Thread
+from typing import Callable, NamedTuple, Optional, Sequence, Union
+
+from stream_downloader.ivideon import record_video, RecordResult
+from stream_downloader.youtube import (download_stream, BackfillResult,
+                                       Rendition)
+from stream_downloader.youtube_video import (fetch_video, VideoResult,
+                                             DownloadBackend)
+from stream_downloader.utils import SegmentCache
+
+
+class ProgressEvent(NamedTuple):
+    name: str
+    stage: str
+    message: str = ''
+    done: Optional[int] = None
+    total: Optional[int] = None
+
+
+class _ThreadedTask(ABC):
+    """
+    Runs a blocking download in a dedicated thread and exposes it to the
+    event loop. `on_progress` is called on the event loop thread. Several
+    tasks may share one `stop_event` to be stopped together.
+    """
+    def __init__(self, name: str,
+                 on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                 stop_event: Optional[Event] = None):
+        self.name = name
+        self.stop_event = Event() if stop_event is None else stop_event
+        self._on_progress = on_progress
+        self._loop = None
+        self._future = None
+
+    @property
+    def running(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    async def start(self):
+        if self._future is not None:
+            raise RuntimeError(f'{self.name} is already started')
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+        Thread(target=self._run_in_thread, name=self.name, daemon=True).start()
+        return self
+
+    async def stop(self):
+        self.stop_event.set()
+        return await self.wait()
+
+    async def wait(self):
+        """
+        Waits for the result. Cancelling the waiting coroutine stops
+        the download as well.
+        """
+        if self._future is None:
+            raise RuntimeError(f'{self.name} is not started')
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            self.stop_event.set()
+            raise
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    @abstractmethod
+    def _run(self):
+        pass
+
+    def _run_in_thread(self):
+        try:
+            result = self._run()
+        except BaseException as e:
+            self._resolve(self._future.set_exception, e)
+        else:
+            self._resolve(self._future.set_result, result)
+
+    def _resolve(self, setter, value):
+        def resolve():
+            if not self._future.done():
+                setter(value)
+        self._loop.call_soon_threadsafe(resolve)
+
+    def _emit(self, stage: str, message: str = '',
+              done: Optional[int] = None, total: Optional[int] = None):
+        if self._on_progress is None:
+            return
+        event = ProgressEvent(self.name, stage, message, done, total)
+        try:
+            self._loop.call_soon_threadsafe(self._on_progress, event)
+        except RuntimeError:
+            pass  # event loop is already closed
+
+    def _log(self, msg: str):
+        self._emit('log', msg)
+
+
+class StreamRecorder(_ThreadedTask):
+    """
+    Records ivideon stream until stopped, result is `RecordResult`.
+    Bounded capture is enabled by default to keep long recordings flat
+    in memory.
+    """
+    def __init__(self, url: str, save_path: Path,
+                 bounded_capture: bool = True,
+                 request_storage_base_dir: Union[Path, None] = None,
+                 on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                 stop_event: Optional[Event] = None):
+        super().__init__(save_path.name, on_progress, stop_event)
+        self.url = url
+        self.save_path = save_path
+        self.bounded_capture = bounded_capture
+        self.request_storage_base_dir = request_storage_base_dir
+
+    def _run(self) -> RecordResult:
+        self.save_path.parent.mkdir(parents=True, exist_ok=True)
+        return record_video(
+            self.url,
+            self.save_path,
+            self._log,
+            request_storage_base_dir=self.request_storage_base_dir,
+            bounded_capture=self.bounded_capture,
+            stop_event=self.stop_event,
+            on_chunk=self._on_chunk
+        )
+
+    def _on_chunk(self, n_chunks: int, size: int):
+        self._emit('chunk', f'{size // 2**20} MB stored', done=n_chunks)
+
+
+class YoutubeBackfill(_ThreadedTask):
+    """
+    Downloads the last hours of youtube stream, result is `BackfillResult`.
+    Parts are processed by thread pools, no subprocesses besides ffmpeg.
+    """
+    def __init__(self, url: str, save_path: Path,
+                 hours: float = .25,
+                 re_encode: bool = False,
+                 download_threads: int = 8,
+                 quality_changed_timeout_sec: int = 2,
+                 renditions: Sequence[Rendition] = (Rendition.BEST,),
+                 segment_cache: Optional[SegmentCache] = None,
+                 on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                 stop_event: Optional[Event] = None):
+        super().__init__(save_path.name, on_progress, stop_event)
+        self.url = url
+        self.save_path = save_path
+        self.hours = hours
+        self.re_encode = re_encode
+        self.download_threads = download_threads
+        self.quality_changed_timeout_sec = quality_changed_timeout_sec
+        self.renditions = renditions
+        self.segment_cache = segment_cache
+
+    def _run(self) -> BackfillResult:
+        self.save_path.parent.mkdir(parents=True, exist_ok=True)
+        return download_stream(
+            self.url,
+            self.save_path,
+            self.hours,
+            self.re_encode,
+            self.download_threads,
+            self.quality_changed_timeout_sec,
+            self.renditions,
+            self.segment_cache,
+            log_msg=self._log,
+            stop_event=self.stop_event,
+            on_progress=self._on_stage,
+            use_threads=True
+        )
+
+    def _on_stage(self, stage: str, done: int, total: int):
+        self._emit(stage, done=done, total=total)
+
+
+class VideoDownloader(_ThreadedTask):
+    """
+    Downloads youtube video, result is `VideoResult`. Actual extension of
+    the output file depends on the best available format.
+    """
+    def __init__(self, url: str, save_path: Path,
+                 backend: DownloadBackend = DownloadBackend.PAFY,
+                 on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                 stop_event: Optional[Event] = None):
+        super().__init__(save_path.name, on_progress, stop_event)
+        self.url = url
+        self.save_path = save_path
+        self.backend = backend
+
+    def _run(self) -> VideoResult:
+        self.save_path.parent.mkdir(parents=True, exist_ok=True)
+        return fetch_video(self.url, self.save_path, self.backend,
+                           self._log, self.stop_event)
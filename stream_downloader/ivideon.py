@@ -6,7 +6,8 @@ import json
 from datetime import datetime, timedelta
 import logging
 from multiprocessing import Process
-from typing import Union
+from threading import Event
+from typing import Callable, NamedTuple, Optional, Union
 
 from tqdm import tqdm
 from selenium.common.exceptions import WebDriverException
@@ -17,18 +18,25 @@ from selenium.webdriver import ActionChains
 
 from stream_downloader.utils import (init_driver, prepare_tmp_file_tree,
                                      cleanup_tmp_file_tree, concat_videos,
-                                     cvt_to_mp4)
+                                     cvt_to_mp4, get_process_tree_rss)
 
 logging.getLogger('urllib3').setLevel(logging.ERROR)
 
 TMP_DIR_NAME = '_tmp_ivsd'
+MAX_NETWORK_BUFFER_SIZE = 64 * 2**20
+MAX_RESOURCE_BUFFER_SIZE = 16 * 2**20
 
 
-def download_video(url: str, save_path: Path, proc_idx: int,
-                   request_storage_base_dir: Union[Path, None]):
-    tmp_dir = prepare_tmp_file_tree(tmp_parent=save_path.parent,
-                                    tmp_dir_basename=TMP_DIR_NAME)
+class RecordResult(NamedTuple):
+    save_path: Optional[Path]
+    n_chunks: int
+    message: str
+    error: Optional[str] = None
 
+
+def download_video(url: str, save_path: Path, proc_idx: int,
+                   request_storage_base_dir: Union[Path, None],
+                   bounded_capture: bool = False):
     def with_prefix(msg):
         return f'{save_path.name}: {msg}'
 
@@ -40,50 +48,120 @@ def download_video(url: str, save_path: Path, proc_idx: int,
     def log_msg(msg, prefix=True):
         log.set_description_str(with_prefix(msg) if prefix else msg)
 
-    try:
-        dump_dir = tmp_dir / 'dump'
-        dump_dir.mkdir(parents=True)
+    record_video(url, save_path, log_msg,
+                 request_storage_base_dir=request_storage_base_dir,
+                 bounded_capture=bounded_capture)
+    log.close()
 
-        dumped = []
-        driver = init_driver(request_storage_base_dir=request_storage_base_dir)
-        for idx, (event, body) in enumerate(get_response_with_video(driver, url)):
+
+def record_video(url: str,
+                 save_path: Path,
+                 log_msg: Callable[[str], None],
+                 request_storage_base_dir: Union[Path, None] = None,
+                 bounded_capture: bool = False,
+                 stop_event: Optional[Event] = None,
+                 on_chunk: Optional[Callable[[int, int], None]] = None
+                 ) -> RecordResult:
+    """
+    Records video chunks until KeyboardInterrupt or until `stop_event` is
+    set, then concatenates them into `save_path`. If recording fails (e.g.
+    browser crashes), already recorded chunks are saved as well and the
+    failure is returned as `error`. `on_chunk` is called with
+    the number of saved chunks and their total size in bytes.
+    """
+    tmp_dir = prepare_tmp_file_tree(tmp_parent=save_path.parent,
+                                    tmp_dir_basename=TMP_DIR_NAME)
+    dump_dir = tmp_dir / 'dump'
+    dump_dir.mkdir(parents=True)
+    dumped = []
+    dumped_size = 0
+    driver = None
+    error = None
+    try:
+        driver = init_driver(request_storage_base_dir=request_storage_base_dir,
+                             bounded_capture=bounded_capture)
+        if bounded_capture and not limit_network_buffers(driver):
+            log_msg('unable to limit browser network buffers, '
+                    'memory usage may grow')
+        responses = get_response_with_video(driver, url, stop_event=stop_event)
+        for idx, (event, body) in enumerate(responses):
             body = body['body']
             out = dump_dir / f'{idx}.ts'
             try:
                 out = dump_body(body, out)
                 if out is not None:
                     dumped.append(out)
-                    log_msg(f'downloaded {idx + 1} chunks')
+                    dumped_size += out.stat().st_size
+                    msg = f'downloaded {idx + 1} chunks'
+                    if bounded_capture:
+                        msg += f'. {get_usage_string(driver, dumped_size)}'
+                    log_msg(msg)
+                    if on_chunk is not None:
+                        on_chunk(len(dumped), dumped_size)
                 else:
                     log_msg(f'unable to download part {idx}, skipping it')
             except Exception as e:
                 log_msg(f'unable to download {out.name}. {e}')
     except KeyboardInterrupt:
-        if len(dumped):
-            log_msg(f'concatenating {len(dumped)} video files')
-            try:
-                ok = concat_videos(dumped, save_path, tmp_dir)
-                concat_result = 'saved' if ok else 'unable to concat videos'
-            except Exception as e:
-                log_msg(
-                    f'unable to concat videos: {e}. '
-                    f'All downloaded video parts could be found in {dump_dir}. '
-                    f'Cleaning up selenium files'
-                )
-                driver.quit()
-                log.close()
-                return
-        else:
-            concat_result = 'nothing to concat :('
-        log_msg(f'{concat_result}. Cleaning up video chunks file tree')
-        cleanup_tmp_file_tree(tmp_dir)
-        log_msg(f'{concat_result}. Cleaning up selenium files')
+        pass
+    except Exception as e:
+        error = str(e)
+        log_msg(f'recording failed: {e}')
+    finally:
+        if driver is not None:
+            log_msg('cleaning up selenium files')
+            quit_driver(driver)
+
+    saved_path = None
+    if len(dumped):
+        log_msg(f'concatenating {len(dumped)} video files')
+        try:
+            ok = concat_videos(dumped, save_path, tmp_dir)
+            concat_result = 'saved' if ok else 'unable to concat videos'
+            saved_path = save_path if ok else None
+        except Exception as e:
+            log_msg(
+                f'unable to concat videos: {e}. '
+                f'All downloaded video parts could be found in {dump_dir}'
+            )
+            return RecordResult(None, len(dumped),
+                                f'unable to concat videos: {e}', error)
+    else:
+        concat_result = 'nothing to concat :('
+    log_msg(f'{concat_result}. Cleaning up video chunks file tree')
+    cleanup_tmp_file_tree(tmp_dir)
+    log_msg(f'{concat_result}. DONE!')
+    return RecordResult(saved_path, len(dumped), concat_result, error)
+
+
+def quit_driver(driver):
+    try:
         driver.quit()
-        log_msg(f'{concat_result}. DONE!')
-        log.close()
+    except Exception:
+        pass  # browser may be already dead, e.g. after a crash
+
+
+def limit_network_buffers(driver) -> bool:
+    try:
+        driver.execute_cdp_cmd('Network.enable', {
+            'maxTotalBufferSize': MAX_NETWORK_BUFFER_SIZE,
+            'maxResourceBufferSize': MAX_RESOURCE_BUFFER_SIZE,
+        })
+    except WebDriverException:
+        return False
+    return True
+
+
+def get_usage_string(driver, dumped_size: int) -> str:
+    # rooted at chromedriver, so each camera reports only its own browser
+    # even when several recordings share one python process
+    rss = get_process_tree_rss(driver.service.process.pid)
+    rss = 'unknown' if rss is None else f'{rss // 2**20} MB'
+    return f'stored {dumped_size // 2**20} MB, RSS {rss}'
 
 
-def get_response_with_video(driver, url, reload_every_sec=10*60):
+def get_response_with_video(driver, url, reload_every_sec=10*60,
+                            stop_event: Optional[Event] = None):
     driver.get(url)
     run_video_if_needed(driver)
     target_content_type = 'video/MP2T'
@@ -117,7 +195,10 @@ def get_response_with_video(driver, url, reload_every_sec=10*60):
         if now >= next_reload:
             next_reload = now + timeout_between_reloads
             driver.get(url)
-        sleep(timeout_between_checks_sec)
+        if stop_event is None:
+            sleep(timeout_between_checks_sec)
+        elif stop_event.wait(timeout_between_checks_sec):
+            return
         logs = driver.get_log('performance')
         for item in filter(is_video, map(parse_response, logs)):
             body = get_body(item)
@@ -159,6 +240,9 @@ def main():
                             help='space separated file names to save ivideon videos')
     arg_parser.add_argument('--move_request_dir', action='store_true',
                             help='Move selenium folder to result_dir')
+    arg_parser.add_argument('--bounded_capture', action='store_true',
+                            help='Keep browser logs and buffers bounded '
+                                 'during long recordings')
 
     args = arg_parser.parse_args()
     assert args.urls is not None, 'Specify urls to download'
@@ -177,7 +261,8 @@ def main():
     for idx, (url, filename) in enumerate(zip(args.urls, args.result_files)):
         p = Process(
             target=download_video,
-            args=(url, args.result_dir / filename, idx, request_storage_base_dir)
+            args=(url, args.result_dir / filename, idx, request_storage_base_dir,
+                  args.bounded_capture)
         )
         p.start()
         processes.append(p)
@@ -1,7 +1,13 @@
+import errno
+import hashlib
+import os
+import re
 import shutil
 from pathlib import Path
+from threading import Event
+from time import time
 from uuid import uuid4 as uuid
-from typing import List, Union
+from typing import List, Optional, Union
 import subprocess
 
 from seleniumwire import webdriver
@@ -9,6 +15,19 @@ from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.chrome.options import Options
 import chromedriver_autoinstaller
 
+VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/embed/|/shorts/)([\w-]{11})')
+# errors of os.link meaning that hard links aren't possible for these paths
+NO_HARD_LINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def raise_if_cancelled(stop_event: Optional[Event]):
+    if stop_event is not None and stop_event.is_set():
+        raise DownloadCancelled()
+
 
 def prepare_tmp_file_tree(tmp_parent: Path, tmp_dir_basename: str):
     tmp_dir = tmp_parent / f'{tmp_dir_basename}_{uuid().hex}'
@@ -22,20 +41,124 @@ def cleanup_tmp_file_tree(tmp_dir):
         shutil.rmtree(tmp_dir)
 
 
-def concat_videos(videos: List[Path], save_filepath: Path, tmp_dir: Path):
+def get_video_key(url: str) -> str:
+    match = VIDEO_ID_RE.search(url)
+    if match is not None:
+        return match.group(1)
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in NO_HARD_LINK_ERRNOS:
+            raise
+        # copy under a temp name, so that an existing dst inode, which may be
+        # hard linked elsewhere, is replaced rather than rewritten in place
+        tmp_dst = dst.parent / f'.{dst.name}.{uuid().hex}.tmp'
+        try:
+            shutil.copyfile(src, tmp_dst)
+            os.replace(tmp_dst, dst)
+        finally:
+            if tmp_dst.exists():
+                tmp_dst.unlink()
+
+
+class SegmentCache(object):
+    """
+    Persistent storage of stream parts addressed by broadcast id, itag and
+    part number. Parts are shared with tmp dirs by hard links, so reusing them
+    costs no extra space. Parts unused for `max_age_sec` are evicted, then
+    the least recently used ones until the cache fits `max_size_bytes`.
+    """
+    def __init__(self, cache_dir: Path,
+                 max_size_bytes: Optional[int] = None,
+                 max_age_sec: Optional[float] = None):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.max_age_sec = max_age_sec
+
+    def get_path(self, stream_id: str, itag: str, part: int) -> Path:
+        return self.cache_dir / stream_id / itag / f'{part}.mp4'
+
+    @staticmethod
+    def restore(cached: Path, dst: Path) -> bool:
+        try:
+            if cached.stat().st_size == 0:
+                return False
+            os.utime(cached)
+            link_or_copy(cached, dst)
+        except FileNotFoundError:
+            return False  # not cached or just evicted by a concurrent run
+        return True
+
+    @staticmethod
+    def store(src: Path, cached: Path):
+        if cached.exists():
+            return
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            link_or_copy(src, cached)
+        except FileExistsError:
+            pass  # stored concurrently
+
+    def evict(self):
+        if not self.cache_dir.exists():
+            return
+        # other runs may evict or store parts concurrently
+        now = time()
+        files = []
+        for f in self.cache_dir.rglob('*.mp4'):
+            try:
+                files.append((f, f.stat()))
+            except FileNotFoundError:
+                continue
+        files.sort(key=lambda f_stat: f_stat[1].st_mtime)
+        total_size = sum(stat.st_size for _, stat in files)
+        for f, stat in files:
+            expired = (self.max_age_sec is not None
+                       and now - stat.st_mtime > self.max_age_sec)
+            oversized = (self.max_size_bytes is not None
+                         and total_size > self.max_size_bytes)
+            if expired or oversized:
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+                total_size -= stat.st_size
+        for d in sorted(self.cache_dir.rglob('*'), reverse=True):
+            try:
+                if d.is_dir() and not any(d.iterdir()):
+                    d.rmdir()
+            except OSError:
+                continue
+
+
+def concat_videos(videos: List[Path], save_filepath: Path, tmp_dir: Path,
+                  audios: Optional[List[Path]] = None):
     if len(videos):
         list_filepath = tmp_dir / 'list.txt'
-        with open(list_filepath, 'w') as f_out:
-            f_out.write('\n'.join(f'file \'{f.absolute()}\'' for f in videos))
+        write_concat_list(videos, list_filepath)
+        if audios:
+            audio_list_filepath = tmp_dir / 'audio_list.txt'
+            write_concat_list(audios, audio_list_filepath)
+            cmd = make_ffmpeg_concat_mux_cmd(list_filepath,
+                                             audio_list_filepath,
+                                             save_filepath)
+        else:
+            cmd = make_ffmpeg_concat_cmd(list_filepath, save_filepath)
 
-        process = subprocess.Popen(
-            make_ffmpeg_concat_cmd(list_filepath, save_filepath),
-            stdout=subprocess.PIPE
-        )
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         process.communicate()
         return process.returncode == 0
 
 
+def write_concat_list(videos: List[Path], list_filepath: Path):
+    with open(list_filepath, 'w') as f_out:
+        f_out.write('\n'.join(f'file \'{f.absolute()}\'' for f in videos))
+
+
 def cvt_to_mp4(src: Path, dst: Path):
     assert src.is_file()
     process = subprocess.Popen(mk_cvt_cmd(src, dst), stdout=subprocess.PIPE)
@@ -53,13 +176,63 @@ def make_ffmpeg_concat_cmd(list_filepath: Path, save_filepath: Path):
     return cmd.format(list_filepath, save_filepath).split()
 
 
+def make_ffmpeg_concat_mux_cmd(video_list_filepath: Path,
+                               audio_list_filepath: Path,
+                               save_filepath: Path):
+    cmd = ('ffmpeg -hide_banner -loglevel error -y '
+           '-f concat -safe 0 -i {} -f concat -safe 0 -i {} '
+           '-map 0:v -map 1:a -c copy {} -nostdin')
+    return cmd.format(video_list_filepath, audio_list_filepath,
+                      save_filepath).split()
+
+
+def get_process_tree_rss(pid: int) -> Optional[int]:
+    """
+    Returns total RSS in bytes of the process and all its descendants
+    (e.g. chromedriver and chrome). Works only where /proc is available.
+    """
+    proc_dir = Path('/proc')
+    if not proc_dir.is_dir():
+        return None
+    children = {}
+    for stat in proc_dir.glob('[0-9]*/stat'):
+        try:
+            # process name may contain spaces, so split after it
+            ppid = int(stat.read_text().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(stat.parent.name))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total, stack = None, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(proc_dir / str(current) / 'statm', 'r') as f:
+                rss = int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            # root process is gone, e.g. chromedriver already exited
+            if current == pid:
+                return None
+            continue
+        total = rss if total is None else total + rss
+        stack.extend(children.get(current, []))
+    return total
+
+
 def init_driver(headless=True,
                 extensions_paths: Union[List[Path], None] = None,
-                request_storage_base_dir: Union[Path, None] = None):
+                request_storage_base_dir: Union[Path, None] = None,
+                bounded_capture: bool = False):
     chromedriver_autoinstaller.install()
     options = Options()
     options.headless = headless
     options.add_experimental_option('w3c', False)
+    if bounded_capture:
+        # network events are enough to pick video responses
+        options.add_experimental_option('perfLoggingPrefs', {
+            'enableNetwork': True,
+            'enablePage': False,
+        })
     if (extensions_paths is not None
             and isinstance(extensions_paths, (list, tuple))):
         for ext in extensions_paths:
@@ -70,9 +243,14 @@ def init_driver(headless=True,
         desired_capabilities=cap,
         options=options
     )
+    seleniumwire_options = {}
     if request_storage_base_dir is not None:
-        kwargs['seleniumwire_options'] = {
-            'request_storage_base_dir': str(request_storage_base_dir)
-        }
+        seleniumwire_options['request_storage_base_dir'] = str(request_storage_base_dir)
+    if bounded_capture:
+        # response bodies are taken through CDP, so selenium-wire
+        # doesn't need to store requests at all
+        seleniumwire_options['disable_capture'] = True
+    if seleniumwire_options:
+        kwargs['seleniumwire_options'] = seleniumwire_options
     driver = webdriver.Chrome(**kwargs)
     return driver
@@ -1,17 +1,28 @@
 import re
+import shutil
 import subprocess
+import urllib.error
 import urllib.request
 from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from functools import partial
 from multiprocessing import Pool, cpu_count
 from pathlib import Path
-from time import sleep
-from typing import List, Optional, Tuple
+from threading import Event
+from time import sleep, time
+from typing import (Callable, Collection, Dict, Iterable, List, NamedTuple,
+                    Optional, Sequence, Tuple)
 
 from tqdm import tqdm
 from selenium.common.exceptions import NoSuchElementException
 
 from stream_downloader.utils import (prepare_tmp_file_tree, init_driver,
-                                     cleanup_tmp_file_tree, concat_videos)
+                                     cleanup_tmp_file_tree, concat_videos,
+                                     SegmentCache,
+                                     DownloadCancelled, raise_if_cancelled)
 
 """
 E.G: "https://r4---sn-gqn-p5ns.googlevideo.com/videoplayback?expire=1603041842& ..... 2.20201016.02.00&sq="
@@ -20,7 +31,30 @@ The sound link should contain: &mime=audio in it.
 
 SEC_PER_PART = 5
 TMP_DIR_NAME = '_tmp_ytsd'
+CACHE_DIR_NAME = '.ytsd_cache'
 URL_RE = re.compile(r'^(.+?&sq=)(\d+)&')
+ITAG_RE = re.compile(r'[?&]itag=(\d+)')
+QUALITY_LABEL_RE = re.compile(r'^(\d+)p')
+STREAM_ID_RE = re.compile(r'[?&]id=([^&]+)')
+VIDEO_CONTENT_TYPES = ['video/mp4', 'video/webm']
+AUDIO_CONTENT_TYPES = ['audio/mp4', 'audio/webm']
+PROXY_WAIT_TIMEOUT_SEC = 30
+AUDIO_WAIT_TIMEOUT_SEC = 30
+PART_DOWNLOAD_TIMEOUT_SEC = 30
+REQUESTS_POLL_INTERVAL_SEC = .5
+
+
+class Rendition(str, Enum):
+    BEST = 'best'
+    AUDIO = 'audio'
+    PROXY = 'proxy'
+
+
+class BackfillResult(NamedTuple):
+    outputs: List[Tuple[Path, bool]]
+    n_parts: int
+    cancelled: bool
+    error: Optional[str] = None
 
 
 def download_stream(video_url: str,
@@ -28,24 +62,61 @@ def download_stream(video_url: str,
                     video_len_hours: float = .25,
                     re_encode: bool = False,
                     download_threads: int = 8,
-                    quality_changed_timeout_sec: int = 2):
+                    quality_changed_timeout_sec: int = 2,
+                    renditions: Sequence[Rendition] = (Rendition.BEST,),
+                    segment_cache: Optional[SegmentCache] = None,
+                    log_msg: Callable[[str], None] = print,
+                    stop_event: Optional[Event] = None,
+                    on_progress: Optional[Callable[[str, int, int], None]] = None,
+                    use_threads: bool = False
+                    ) -> BackfillResult:
+    """
+    Downloads the last `video_len_hours` of the stream. Setting `stop_event`
+    interrupts the download like KeyboardInterrupt does. If `on_progress` is
+    given, it's called with stage name, done and total items instead of
+    showing progress bars. With `use_threads` parts are processed by thread
+    pools instead of process pools, which is safe to run from a thread of
+    a bigger application. Only then messages of pool workers go to `log_msg`,
+    otherwise they are printed.
+    """
     tmp_dir = prepare_tmp_file_tree(tmp_parent=save_filepath.parent,
                                     tmp_dir_basename=TMP_DIR_NAME)
+    outputs, n_parts, cancelled, error = [], 0, False, None
+    progress = dict(stop_event=stop_event, on_progress=on_progress,
+                    log_msg=log_msg, use_threads=use_threads)
     try:
-        video_url = _get_video_file_url(video_url, quality_changed_timeout_sec)
-        videos = _download(video_url, video_len_hours, tmp_dir, pool_size=download_threads)
-        videos = _re_encode(videos, tmp_dir) if re_encode else videos
-        videos = _filter_valid_video(videos)
-        print('Concatenating videos...')
-        ok = concat_videos(videos, save_filepath, tmp_dir)
-        if ok:
-            print(f'DONE! Saved to {save_filepath}')
+        rendition_urls = _get_stream_urls(video_url, renditions,
+                                          quality_changed_timeout_sec,
+                                          log_msg=log_msg, stop_event=stop_event)
+        parts = _download(rendition_urls, video_len_hours, tmp_dir, pool_size=download_threads,
+                          segment_cache=segment_cache, **progress)
+        videos = [video for video, _ in parts]
+        if re_encode:
+            videos = _re_encode(videos, tmp_dir, **progress)
+            validated = set()
         else:
-            print('Unable to concat files')
-        cleanup_tmp_file_tree(tmp_dir)
+            validated = set(video for video, checked in parts if checked)
+        videos = _filter_valid_video(videos, validated=validated, **progress)
+        n_parts = len(videos)
+        log_msg('Concatenating videos...')
+        outputs = _save_renditions(videos, save_filepath, tmp_dir)
+        for filepath, ok in outputs:
+            if ok:
+                log_msg(f'DONE! Saved to {filepath}')
+            else:
+                log_msg(f'Unable to concat files to {filepath}')
     except KeyboardInterrupt:
-        print('Keyboard interrupt, cleaning up...')
+        log_msg('Keyboard interrupt, cleaning up...')
+        cancelled = True
+    except DownloadCancelled:
+        log_msg('Download cancelled, cleaning up...')
+        cancelled = True
+    except Exception as e:
+        log_msg(f'Unable to download the stream: {e}, cleaning up...')
+        error = str(e)
+    finally:
         cleanup_tmp_file_tree(tmp_dir)
+    return BackfillResult(outputs, n_parts, cancelled, error)
 
 
 def click(driver, elt):
@@ -53,6 +124,14 @@ def click(driver, elt):
 
 
 def choose_best_quality(driver, quality_changed_timeout_sec):
+    choose_quality(driver, quality_changed_timeout_sec, pick=max)
+
+
+def choose_lowest_quality(driver, quality_changed_timeout_sec):
+    choose_quality(driver, quality_changed_timeout_sec, pick=min)
+
+
+def choose_quality(driver, quality_changed_timeout_sec, pick=max):
     settings_btn = driver.find_element_by_css_selector(
         'button.ytp-button.ytp-settings-button'
     )
@@ -82,88 +161,222 @@ def choose_best_quality(driver, quality_changed_timeout_sec):
         const player = document.getElementById('movie_player');
         return player.getAvailableQualityLabels();
     """)
-    try:
-        max_quality_label = max(available_quality_labels,
-                                key=lambda l: int(l.split('p')[0]))
-    except:
-        max_quality_label = available_quality_labels[0]
-    control = find_quality_control(max_quality_label)
+    # labels like 'Auto' can't be compared with the others
+    numeric_labels = [l for l in available_quality_labels
+                      if QUALITY_LABEL_RE.match(l)]
+    if numeric_labels:
+        quality_label = pick(numeric_labels,
+                             key=lambda l: int(QUALITY_LABEL_RE.match(l).group(1)))
+    else:
+        quality_label = available_quality_labels[0]
+    control = find_quality_control(quality_label)
     if control is not None:
         click(driver, control)
         sleep(quality_changed_timeout_sec)
 
 
-def _get_video_file_url(url: str, quality_changed_timeout_sec: int):
-    print('Initializing driver...')
+def _get_stream_urls(url: str,
+                     renditions: Sequence[Rendition],
+                     quality_changed_timeout_sec: int,
+                     log_msg: Callable[[str], None] = print,
+                     stop_event: Optional[Event] = None) -> Dict[Rendition, str]:
+    log_msg('Initializing driver...')
     adblock_filepath = Path(__file__).parent.absolute() / 'adblock_plus.crx'
     driver = init_driver(headless=False, extensions_paths=[adblock_filepath])
+    try:
+        log_msg(f'Connecting to {url}...')
+        driver.get(url)
+        driver.maximize_window()
+        sleep(1)
+        choose_best_quality(driver, quality_changed_timeout_sec)
+
+        log_msg('Picking video url...')
+        result = OrderedDict()
+        best_url = _wait_for_stream_url(driver, VIDEO_CONTENT_TYPES,
+                                        stop_event=stop_event)
+        if Rendition.BEST in renditions:
+            result[Rendition.BEST] = best_url
+        if Rendition.AUDIO in renditions:
+            # DASH player requests audio along with video, no need to switch
+            log_msg('Picking audio url...')
+            audio_url = _wait_for_stream_url(
+                driver, AUDIO_CONTENT_TYPES,
+                timeout_sec=AUDIO_WAIT_TIMEOUT_SEC,
+                stop_event=stop_event
+            )
+            if audio_url is None:
+                log_msg('Unable to find separate audio track, skipping audio')
+            else:
+                result[Rendition.AUDIO] = audio_url
+        if Rendition.PROXY in renditions:
+            log_msg('Picking proxy video url...')
+            begin = len(driver.requests)
+            choose_lowest_quality(driver, quality_changed_timeout_sec)
+            proxy_url = _wait_for_stream_url(
+                driver, VIDEO_CONTENT_TYPES, begin=begin,
+                exclude_itags=[_parse_itag(best_url)],
+                timeout_sec=PROXY_WAIT_TIMEOUT_SEC,
+                stop_event=stop_event
+            )
+            if proxy_url is None:
+                log_msg('Unable to find low quality video, skipping proxy')
+            else:
+                result[Rendition.PROXY] = proxy_url
+    finally:
+        driver.quit()
+    return result
 
-    print(f'Connecting to {url}...')
-    driver.get(url)
-    driver.maximize_window()
-    sleep(1)
-    choose_best_quality(driver, quality_changed_timeout_sec)
-
-    print('Picking video url...')
-    target_content_types = ['video/mp4', 'video/webm']
 
+def _wait_for_stream_url(driver,
+                         content_types: List[str],
+                         begin: int = 0,
+                         exclude_itags: Sequence[Optional[str]] = (),
+                         timeout_sec: Optional[float] = None,
+                         stop_event: Optional[Event] = None) -> Optional[str]:
     def is_target(request):
         return (
                 'videoplayback' in request.path
                 and request.response is not None
-                and request.response.headers['Content-Type'] in target_content_types
+                and request.response.headers['Content-Type'] in content_types
                 and URL_RE.match(request.url) is not None
+                and _parse_itag(request.url) not in exclude_itags
         )
 
-    target = None
-    begin, end = 0, len(driver.requests)
-    while True:
+    deadline = None if timeout_sec is None else time() + timeout_sec
+    end = len(driver.requests)
+    while deadline is None or time() < deadline:
+        raise_if_cancelled(stop_event)
         for r in reversed(driver.requests[begin:end]):
             if is_target(r):
-                target = r
-                break
-        else:
-            begin, end = end, len(driver.requests)
-            continue
-        break
-    driver.quit()
-    return target.url
+                return r.url
+        sleep(REQUESTS_POLL_INTERVAL_SEC)
+        begin, end = end, len(driver.requests)
+    return None
+
+
+def _parse_itag(url: str) -> Optional[str]:
+    match = ITAG_RE.search(url)
+    return None if match is None else match.group(1)
 
 
-def _process_download(in_out: Tuple[str, Path],
-                      retrieve_count: int = 20) -> Optional[Path]:
+def _parse_stream_id(url: str) -> Optional[str]:
+    # unlike the page url, id of videoplayback url changes between broadcasts
+    match = STREAM_ID_RE.search(url)
+    return None if match is None else re.sub(r'[^\w.-]', '_', match.group(1))
+
+
+def _process_download(in_out: Tuple[str, Path, Optional[Path]],
+                      retrieve_count: int = 20,
+                      log_msg: Callable[[str], None] = print,
+                      stop_event: Optional[Event] = None
+                      ) -> Optional[Tuple[Path, bool]]:
+    """
+    Returns the part and whether it's already checked by ffprobe.
+    """
     retrieve_count = max(1, retrieve_count)
-    url, vid_out = in_out
+    url, vid_out, cached = in_out
+    raise_if_cancelled(stop_event)
+    if cached is not None and SegmentCache.restore(cached, vid_out):
+        return vid_out, True
     for retrieve_idx in range(retrieve_count):
+        raise_if_cancelled(stop_event)
         try:
-            _, msg = urllib.request.urlretrieve(url, vid_out)
-            return vid_out
+            _retrieve(url, vid_out)
+            break
         except Exception as e:
-            print(f'Unable to download part {vid_out.stem}: {e}. Trying for {retrieve_idx} time')
-            sleep(1 + retrieve_idx)
-    print(f'Skipped part {vid_out.stem}, unable to download')
-    return None
+            log_msg(f'Unable to download part {vid_out.stem}: {e}. Trying for {retrieve_idx} time')
+            raise_if_cancelled(stop_event)
+            if stop_event is not None:
+                stop_event.wait(1 + retrieve_idx)
+            else:
+                sleep(1 + retrieve_idx)
+    else:
+        log_msg(f'Skipped part {vid_out.stem}, unable to download')
+        return None
+    if cached is None:
+        return vid_out, False
+    # only valid parts are cached, otherwise a broken part would be
+    # reused and dropped by every later run
+    try:
+        if not _is_valid(vid_out, log_msg):
+            return None
+        SegmentCache.store(vid_out, cached)
+    except OSError as e:
+        log_msg(f'Unable to cache part {vid_out.stem}: {e}')
+        return vid_out, False
+    return vid_out, True
+
+
+def _retrieve(url: str, vid_out: Path, timeout_sec: float = PART_DOWNLOAD_TIMEOUT_SEC):
+    # unlike urlretrieve, a stalled connection fails after `timeout_sec`
+    with urllib.request.urlopen(url, timeout=timeout_sec) as response, \
+            open(vid_out, 'wb') as f:
+        shutil.copyfileobj(response, f)
+        expected_size = response.headers.get('Content-Length')
+    if expected_size is not None and vid_out.stat().st_size < int(expected_size):
+        raise urllib.error.ContentTooShortError(
+            f'retrieval incomplete: got only {vid_out.stat().st_size} '
+            f'out of {expected_size} bytes', None
+        )
 
 
-def _download(video_url: str,
+def _download(rendition_urls: Dict[Rendition, str],
               video_len_hours: float,
               tmp_dir: Path,
-              pool_size: int = 16) -> List[Path]:
-    url, current_part = _parse_video_url(video_url)
+              pool_size: int = 16,
+              segment_cache: Optional[SegmentCache] = None,
+              log_msg: Callable[[str], None] = print,
+              stop_event: Optional[Event] = None,
+              on_progress: Optional[Callable[[str, int, int], None]] = None,
+              use_threads: bool = False
+              ) -> List[Tuple[Path, bool]]:
+    """
+    Downloads the same range of parts for every rendition with a single
+    pool. Parts are stored in `tmp_dir/videos/<rendition>/<sq>.mp4`.
+    Parts found in `segment_cache` are linked instead of downloading.
+    Returns parts along with whether they are already checked by ffprobe.
+    """
+    urls = OrderedDict((rendition, _parse_video_url(video_url))
+                       for rendition, video_url in rendition_urls.items())
+    # renditions are captured at slightly different moments, so the last
+    # part available for all of them is the earliest of the current ones
+    current_part = min(part for _, part in urls.values())
     n_parts = int(video_len_hours * 3600 / SEC_PER_PART)
     begin, end = max(1, current_part - n_parts + 1 * bool(n_parts)), current_part
 
-    vid_dir = tmp_dir / 'videos'
-    vid_dir.mkdir(parents=True)
-
-    input_output = [(f'{url}{part}', vid_dir / f'{part}.mp4')
-                    for part in range(begin, end + 1)]
+    for rendition in urls:
+        (tmp_dir / 'videos' / rendition.value).mkdir(parents=True)
 
-    with Pool(pool_size) as p:
-        result = tqdm(p.imap(_process_download, input_output),
-                      desc='Downloading video parts of the stream: ', total=len(input_output))
+    def get_cached_path(rendition, url, part):
+        stream_id = _parse_stream_id(url)
+        if segment_cache is None or stream_id is None:
+            return None
+        itag = _parse_itag(url) or rendition.value
+        return segment_cache.get_path(stream_id, itag, part)
+
+    input_output = [(f'{url}{part}',
+                     tmp_dir / 'videos' / rendition.value / f'{part}.mp4',
+                     get_cached_path(rendition, url, part))
+                    for part in range(begin, end + 1)
+                    for rendition, (url, _) in urls.items()]
+    if segment_cache is not None:
+        n_cached = sum(cached is not None and cached.is_file()
+                       for _, _, cached in input_output)
+        log_msg(f'Reusing {n_cached} of {len(input_output)} cached video parts')
+
+    # events can't be passed to worker processes, there the pool is
+    # terminated on exit instead
+    process = partial(_process_download,
+                      log_msg=_worker_log_msg(log_msg, use_threads),
+                      stop_event=stop_event if use_threads else None)
+    with _imap(process, input_output, pool_size, use_threads) as results:
+        result = _track(results,
+                        'download', 'Downloading video parts of the stream: ',
+                        len(input_output), stop_event, on_progress)
         result = [r for r in result if r is not None]
 
+    if segment_cache is not None:
+        segment_cache.evict()
     return result
 
 
@@ -174,8 +387,83 @@ def _parse_video_url(url):
     return match.group(1), int(match.group(2))
 
 
+@contextmanager
+def _imap(func: Callable, items: List, pool_size: int, use_threads: bool):
+    if not use_threads:
+        with Pool(pool_size) as p:
+            yield p.imap(func, items)
+        return
+    executor = ThreadPoolExecutor(pool_size)
+    futures = [executor.submit(func, item) for item in items]
+    try:
+        yield (f.result() for f in futures)
+    finally:
+        # drop not started items and don't wait for running ones, e.g. when
+        # cancelled, they check the stop event themselves
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _worker_log_msg(log_msg: Callable[[str], None], use_threads: bool):
+    # messages of worker processes can't be passed back to arbitrary callbacks
+    return log_msg if use_threads else print
+
+
+def _track(results: Iterable,
+           stage: str,
+           desc: str,
+           total: int,
+           stop_event: Optional[Event] = None,
+           on_progress: Optional[Callable[[str, int, int], None]] = None):
+    if on_progress is None:
+        results = tqdm(results, desc=desc, total=total)
+    for idx, result in enumerate(results):
+        raise_if_cancelled(stop_event)
+        if on_progress is not None:
+            on_progress(stage, idx + 1, total)
+        yield result
+
+
+def _group_by_rendition(videos: List[Path]) -> Dict[Rendition, List[Path]]:
+    result = OrderedDict()
+    for video in videos:
+        result.setdefault(Rendition(video.parent.name), []).append(video)
+    return result
+
+
+def _get_rendition_filepath(save_filepath: Path, rendition: Rendition) -> Path:
+    if rendition == Rendition.BEST:
+        return save_filepath
+    return save_filepath.parent / f'{save_filepath.stem}_{rendition.value}{save_filepath.suffix}'
+
+
+def _save_renditions(videos: List[Path],
+                     save_filepath: Path,
+                     tmp_dir: Path) -> List[Tuple[Path, bool]]:
+    parts = _group_by_rendition(videos)
+    best = parts.pop(Rendition.BEST, None)
+    audio = parts.get(Rendition.AUDIO)
+    result = []
+    if best:
+        if audio:
+            # audio is muxed into the main output while concatenating video.
+            # Both tracks are concatenated as independent timelines, so a part
+            # missing in one of them would shift the rest out of sync
+            common = set(v.stem for v in best) & set(a.stem for a in audio)
+            best = [v for v in best if v.stem in common]
+            audio = [a for a in audio if a.stem in common]
+            parts.pop(Rendition.AUDIO)
+        ok = concat_videos(best, save_filepath, tmp_dir, audios=audio)
+        result.append((save_filepath, ok))
+    for rendition, rendition_parts in parts.items():
+        filepath = _get_rendition_filepath(save_filepath, rendition)
+        ok = concat_videos(rendition_parts, filepath, tmp_dir)
+        result.append((filepath, ok))
+    return result
+
+
 def _process_re_encode(in_out: Tuple[Path, Path],
-                       rm_processed: bool = True) -> Optional[Path]:
+                       rm_processed: bool = True,
+                       log_msg: Callable[[str], None] = print) -> Optional[Path]:
     video, vid_out = in_out
     process = subprocess.Popen(
         _make_ffmpeg_re_encode_cmd(video, vid_out),
@@ -185,7 +473,7 @@ def _process_re_encode(in_out: Tuple[Path, Path],
     if rm_processed:
         video.unlink()
     if process.returncode != 0:
-        print(f'Unable to re-encode {video}, skipping it')
+        log_msg(f'Unable to re-encode {video}, skipping it')
         return None
     else:
         return vid_out
@@ -193,15 +481,24 @@ def _process_re_encode(in_out: Tuple[Path, Path],
 
 def _re_encode(videos: List[Path],
                tmp_dir: Path,
-               pool_size: int = cpu_count()) -> List[Path]:
+               pool_size: int = cpu_count(),
+               stop_event: Optional[Event] = None,
+               on_progress: Optional[Callable[[str, int, int], None]] = None,
+               log_msg: Callable[[str], None] = print,
+               use_threads: bool = False
+               ) -> List[Path]:
     re_enc_dir = tmp_dir / 'fixed'
-    re_enc_dir.mkdir(parents=True)
+    for rendition_dir in set(video.parent.name for video in videos):
+        (re_enc_dir / rendition_dir).mkdir(parents=True)
 
-    input_output = [(video, re_enc_dir / video.name) for video in videos]
+    input_output = [(video, re_enc_dir / video.parent.name / video.name)
+                    for video in videos]
 
-    with Pool(pool_size) as p:
-        result = tqdm(p.imap(_process_re_encode, input_output),
-                      desc='Re-encoding video parts of the stream: ', total=len(input_output))
+    process = partial(_process_re_encode, log_msg=_worker_log_msg(log_msg, use_threads))
+    with _imap(process, input_output, pool_size, use_threads) as results:
+        result = _track(results,
+                        're_encode', 'Re-encoding video parts of the stream: ',
+                        len(input_output), stop_event, on_progress)
         result = [r for r in result if r is not None]
 
     return result
@@ -211,24 +508,33 @@ def _make_ffmpeg_re_encode_cmd(in_: Path, out: Path):
     return f'ffmpeg -hide_banner -loglevel error -i {in_} -c copy {out} -nostdin'.split()
 
 
-def _is_valid(vid: Path) -> bool:
+def _is_valid(vid: Path, log_msg: Callable[[str], None] = print) -> bool:
     cmd = _make_ffprobe_cmd(vid)
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     process.communicate()
     if process.returncode != 0:
-        print(f'Invalid video {vid}, skipping it')
+        log_msg(f'Invalid video {vid}, skipping it')
         return False
     return True
 
 
 def _filter_valid_video(videos: List[Path],
-                        pool_size: int = cpu_count()) -> List[Path]:
-    with Pool(pool_size) as p:
-        result = tqdm(p.imap(_is_valid, videos),
-                      desc='Filtering invalid videos: ', total=len(videos))
-        result = [vid for valid, vid in zip(result, videos) if valid]
-
-    return result
+                        pool_size: int = cpu_count(),
+                        stop_event: Optional[Event] = None,
+                        on_progress: Optional[Callable[[str, int, int], None]] = None,
+                        log_msg: Callable[[str], None] = print,
+                        use_threads: bool = False,
+                        validated: Collection[Path] = ()
+                        ) -> List[Path]:
+    to_check = [vid for vid in videos if vid not in validated]
+    process = partial(_is_valid, log_msg=_worker_log_msg(log_msg, use_threads))
+    with _imap(process, to_check, pool_size, use_threads) as results:
+        result = _track(results,
+                        'validate', 'Filtering invalid videos: ',
+                        len(to_check), stop_event, on_progress)
+        valid = set(vid for is_valid, vid in zip(result, to_check) if is_valid)
+
+    return [vid for vid in videos if vid in validated or vid in valid]
 
 
 def _make_ffprobe_cmd(vid: Path):
@@ -249,6 +555,17 @@ def main():
                             help='Re-encodes video chunks before concat')
     arg_parser.add_argument('--download-threads', type=int, default=4)
     arg_parser.add_argument('--quality_changed_timeout_sec', type=int, default=2)
+    arg_parser.add_argument('--renditions', type=Rendition, nargs='+',
+                            default=[Rendition.BEST],
+                            help='space separated renditions to capture. '
+                                 'Possible options: best, audio, proxy')
+    arg_parser.add_argument('--cache_segments', action='store_true',
+                            help='Keep downloaded video parts in result_dir '
+                                 'and reuse them in later runs')
+    arg_parser.add_argument('--cache_max_size_gb', type=float, default=20,
+                            help='max size of cached video parts')
+    arg_parser.add_argument('--cache_max_age_hours', type=float, default=24,
+                            help='max time to keep unused cached video parts')
 
     args = arg_parser.parse_args()
     assert args.urls is not None, 'Specify urls to download'
@@ -257,16 +574,27 @@ def main():
     assert len(args.urls) == len(args.result_files), \
         'Number of videos should be equal to the number of output files'
     args.result_dir.mkdir(parents=True, exist_ok=True)
+    segment_cache = None
+    if args.cache_segments:
+        segment_cache = SegmentCache(
+            args.result_dir / CACHE_DIR_NAME,
+            max_size_bytes=int(args.cache_max_size_gb * 2**30),
+            max_age_sec=args.cache_max_age_hours * 3600
+        )
     for url, filename in zip(args.urls, args.result_files):
         try:
-            download_stream(
+            result = download_stream(
                 url,
                 args.result_dir / filename,
                 args.download_last_hours,
                 args.re_encode,
                 args.download_threads,
-                args.quality_changed_timeout_sec
+                args.quality_changed_timeout_sec,
+                args.renditions,
+                segment_cache
             )
+            if result.error is not None:
+                print(f'Unable to download {url} ({filename}): {result.error}')
         except Exception as e:
             print(f'Unable to download {url} ({filename}), skipping it: {e}')
             continue
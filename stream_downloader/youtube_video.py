@@ -1,23 +1,45 @@
 from argparse import ArgumentParser
 from pathlib import Path
 import logging
+import glob
+import json
+import os
 from enum import Enum
-from multiprocessing import Process
+from threading import Event
+from time import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from multiprocessing import Pool, Process, Value
 from multiprocessing import RLock, freeze_support
 
 from tqdm import tqdm
 import pafy
 import youtube_dl
 
+from stream_downloader.utils import (get_video_key, DownloadCancelled,
+                                     raise_if_cancelled)
 
 logging.getLogger('urllib3').setLevel(logging.ERROR)
 
+CACHE_DIR_NAME = '.ytvd_cache'
+
 
 class DownloadBackend(str, Enum):
     PAFY = 'pafy'
     YTDL = 'ytdl'
 
 
+class VideoResult(NamedTuple):
+    path: Optional[Path]
+    size: Optional[int]
+    cancelled: bool
+
+
+class BatchStatus(str, Enum):
+    DOWNLOADED = 'downloaded'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+
 def main():
     arg_parser = ArgumentParser('Downloading videos from youtube')
     arg_parser.add_argument('--urls', type=str, nargs='+',
@@ -29,9 +51,33 @@ def main():
     arg_parser.add_argument('--backend', type=DownloadBackend,
                             default=DownloadBackend.PAFY,
                             help='Lib to save video. Possible options: pafy, ytdl')
+    arg_parser.add_argument('--urls_file', type=Path,
+                            help='file with youtube video URLs (one per line, '
+                                 'optionally followed by output file name). '
+                                 'Enables batch mode')
+    arg_parser.add_argument('--workers', type=int, default=4,
+                            help='number of parallel downloads in batch mode')
+    arg_parser.add_argument('--cache_dir', type=Path,
+                            help='dir to cache extracted video metadata in '
+                                 'batch mode. Defaults to result_dir/'
+                                 f'{CACHE_DIR_NAME}')
+    arg_parser.add_argument('--cache_ttl_hours', type=float, default=3,
+                            help='lifetime of cached video metadata')
     args = arg_parser.parse_args()
-    assert args.urls is not None, 'Specify urls to download'
     assert args.result_dir is not None, 'Specify dir to save videos'
+    if args.urls_file is not None:
+        assert args.urls_file.is_file(), f'{args.urls_file} is not a file'
+        args.result_dir.mkdir(parents=True, exist_ok=True)
+        freeze_support()  # for Windows support
+        download_batch(
+            read_urls_file(args.urls_file),
+            args.result_dir,
+            workers=args.workers,
+            cache_dir=args.cache_dir or args.result_dir / CACHE_DIR_NAME,
+            cache_ttl_hours=args.cache_ttl_hours
+        )
+        return
+    assert args.urls is not None, 'Specify urls to download'
     assert args.result_files is not None, 'Specify output video filenames'
     assert len(args.urls) == len(args.result_files), \
         'Number of videos should be equal to the number of output files'
@@ -59,14 +105,8 @@ def download_video(url: str,
         proc_idx,
         prefix=f'{save_path.stem} ({backend.name})'
     )
-    if backend == DownloadBackend.PAFY:
-        downloader = pafy_download
-    elif backend == DownloadBackend.YTDL:
-        downloader = ytdl_download
-    else:
-        assert False
     try:
-        filename = downloader(url, save_path, log_msg)
+        filename = get_downloader(backend)(url, save_path, log_msg)
         msg = f'Downloaded'
         if filename.is_file():
             msg += f'. File size: {int(b_to_mb(filename.stat().st_size))} MB'
@@ -76,6 +116,38 @@ def download_video(url: str,
     # close()
 
 
+def get_downloader(backend: DownloadBackend):
+    if backend == DownloadBackend.PAFY:
+        return pafy_download
+    elif backend == DownloadBackend.YTDL:
+        return ytdl_download
+    else:
+        assert False
+
+
+def fetch_video(url: str,
+                save_path: Path,
+                backend: DownloadBackend,
+                log_msg: Callable[[str], None],
+                stop_event: Optional[Event] = None) -> VideoResult:
+    """
+    Downloads video without progress bars. Setting `stop_event` aborts the
+    download on the next progress update.
+    """
+    def log_msg_or_cancel(msg):
+        # raised from download callbacks it aborts download of both backends
+        raise_if_cancelled(stop_event)
+        log_msg(msg)
+
+    try:
+        raise_if_cancelled(stop_event)
+        filename = get_downloader(backend)(url, save_path, log_msg_or_cancel)
+    except DownloadCancelled:
+        return VideoResult(None, None, True)
+    size = filename.stat().st_size if filename.is_file() else None
+    return VideoResult(filename, size, False)
+
+
 def make_tqdm_logger(position: int, prefix: str = None):
     prefix = '' if prefix is None else f'{prefix}: '
 
@@ -149,7 +221,7 @@ def _mk_pafy_callback(log_msg):
     return callback
 
 
-def ytdl_download(url: str, output: Path, log_msg) -> Path:
+def _mk_ytdl_logger(log_msg):
     class Logger(object):
         def debug(self, msg):
             pass
@@ -159,7 +231,10 @@ def ytdl_download(url: str, output: Path, log_msg) -> Path:
 
         def error(self, msg):
             log_msg(msg)
+    return Logger()
 
+
+def _mk_ytdl_hook(log_msg):
     def hook(d):
         status = d['status']
         if status == 'finished':
@@ -176,10 +251,13 @@ def ytdl_download(url: str, output: Path, log_msg) -> Path:
                 eta_sec=d['eta'],
                 total_bytes=total_bytes or 0
             ))
+    return hook
+
 
+def ytdl_download(url: str, output: Path, log_msg) -> Path:
     opts = dict(
-        logger=Logger(),
-        progress_hooks=[hook],
+        logger=_mk_ytdl_logger(log_msg),
+        progress_hooks=[_mk_ytdl_hook(log_msg)],
         outtmpl=str(output.parent / f'{output.stem}.%(ext)s'),
         verbose=False,
     )
@@ -189,5 +267,206 @@ def ytdl_download(url: str, output: Path, log_msg) -> Path:
     return filename
 
 
+def read_urls_file(path: Path) -> List[Tuple[str, Optional[str]]]:
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            url, *filename = line.split(maxsplit=1)
+            entries.append((url, filename[0] if filename else None))
+    return entries
+
+
+class MetadataCache(object):
+    """
+    On-disk cache of youtube_dl extraction results keyed by video id.
+    Extracted info expires after `ttl_sec` (format URLs are signed and
+    short-lived), while records of finished downloads are kept until
+    the output file disappears or changes its size.
+    """
+    def __init__(self, cache_dir: Path, ttl_sec: float):
+        self.cache_dir = cache_dir
+        self.ttl_sec = ttl_sec
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_info(self, key: str) -> Optional[dict]:
+        entry = self._load(key)
+        if time() - entry.get('extracted_at', 0) > self.ttl_sec:
+            return None
+        return entry.get('info')
+
+    def put_info(self, key: str, info: dict):
+        entry = self._load(key)
+        entry.update(extracted_at=time(), info=info)
+        self._dump(key, entry)
+
+    def drop_info(self, key: str):
+        entry = self._load(key)
+        entry.pop('info', None)
+        entry.pop('extracted_at', None)
+        self._dump(key, entry)
+
+    def get_output(self, key: str, save_path: Path) -> Optional[Path]:
+        output = self._load(key).get('output')
+        if output is None:
+            return None
+        path = Path(output['path'])
+        # extension of the output depends on the downloaded format
+        if (path.parent != save_path.parent.absolute()
+                or path.stem != save_path.stem):
+            return None
+        if not path.is_file() or path.stat().st_size != output['size']:
+            return None
+        return path
+
+    def put_output(self, key: str, path: Path):
+        entry = self._load(key)
+        entry['output'] = dict(path=str(path.absolute()),
+                               size=path.stat().st_size)
+        self._dump(key, entry)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.json'
+
+    def _load(self, key: str) -> dict:
+        try:
+            with open(self._path(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _dump(self, key: str, entry: dict):
+        path = self._path(key)
+        tmp_path = path.parent / f'{path.name}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            tmp_path.replace(path)
+        except (OSError, TypeError, ValueError):
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+_batch_worker = {}
+
+
+def _init_batch_worker(lock, counter, cache_dir: Path, cache_ttl_sec: float):
+    tqdm.set_lock(lock)
+    with counter.get_lock():
+        counter.value += 1
+        position = counter.value
+    log_msg, _ = make_tqdm_logger(position)
+    prefix = ['']
+
+    def prefixed_log_msg(msg):
+        log_msg(f'{prefix[0]}{msg}', prefix=False)
+
+    # one extractor per worker, so player JS and signature functions
+    # are fetched and parsed once instead of once per video
+    ydl = youtube_dl.YoutubeDL(dict(
+        logger=_mk_ytdl_logger(prefixed_log_msg),
+        progress_hooks=[_mk_ytdl_hook(prefixed_log_msg)],
+        verbose=False,
+    ))
+    _batch_worker.update(
+        ydl=ydl,
+        cache=MetadataCache(cache_dir, cache_ttl_sec),
+        log_msg=prefixed_log_msg,
+        prefix=prefix
+    )
+
+
+def find_existing_output(save_path: Path, info: dict) -> Optional[Path]:
+    """
+    Looks for a file saved by an earlier run without a cache record,
+    i.e. `save_path` with any extension and size of one of the formats.
+    """
+    sizes = set(f.get('filesize') for f in info.get('formats') or [])
+    sizes.add(info.get('filesize'))
+    sizes.discard(None)
+    for path in save_path.parent.glob(f'{glob.escape(save_path.stem)}.*'):
+        if (path.suffix not in ('.part', '.ytdl')
+                and path.is_file() and path.stat().st_size in sizes):
+            return path
+    return None
+
+
+def _batch_download(url_and_path: Tuple[str, Path]) -> Tuple[str, BatchStatus, str]:
+    url, save_path = url_and_path
+    ydl = _batch_worker['ydl']
+    cache = _batch_worker['cache']
+    log_msg = _batch_worker['log_msg']
+    _batch_worker['prefix'][0] = f'{save_path.stem}: '
+    key = get_video_key(url)
+
+    downloaded = cache.get_output(key, save_path)
+    if downloaded is not None:
+        log_msg('already downloaded, skipping')
+        return url, BatchStatus.SKIPPED, str(downloaded)
+
+    ydl.params['outtmpl'] = str(save_path.parent / f'{save_path.stem}.%(ext)s')
+    info = cache.get_info(key)
+    from_cache = info is not None
+    while True:
+        try:
+            if info is None:
+                log_msg('extracting metadata...')
+                info = ydl.extract_info(url, download=False, process=False)
+                cache.put_info(key, info)
+            existing = find_existing_output(save_path, info)
+            if existing is not None:
+                cache.put_output(key, existing)
+                log_msg('already downloaded, skipping')
+                return url, BatchStatus.SKIPPED, str(existing)
+            info = ydl.process_ie_result(info, download=True)
+            filename = Path(ydl.prepare_filename(info))
+            break
+        except Exception as e:
+            if from_cache:
+                # format URLs of cached metadata may be already expired
+                cache.drop_info(key)
+                info, from_cache = None, False
+                continue
+            log_msg(f'unable to download: {e}')
+            return url, BatchStatus.FAILED, str(e)
+    if filename.is_file():
+        cache.put_output(key, filename)
+        log_msg(f'downloaded. File size: '
+                f'{int(b_to_mb(filename.stat().st_size))} MB')
+    return url, BatchStatus.DOWNLOADED, str(filename)
+
+
+def download_batch(entries: List[Tuple[str, Optional[str]]],
+                   result_dir: Path,
+                   workers: int = 4,
+                   cache_dir: Optional[Path] = None,
+                   cache_ttl_hours: float = 3):
+    cache_dir = result_dir / CACHE_DIR_NAME if cache_dir is None else cache_dir
+    tasks = [(url, result_dir / (filename or get_video_key(url)))
+             for url, filename in entries]
+    tqdm.set_lock(RLock())  # for managing output contention
+    counter = Value('i', 0)
+    results = {status: 0 for status in BatchStatus}
+    failed = []
+    with Pool(max(1, workers),
+              initializer=_init_batch_worker,
+              initargs=(tqdm.get_lock(), counter, cache_dir,
+                        cache_ttl_hours * 3600)) as p:
+        progress = tqdm(p.imap_unordered(_batch_download, tasks),
+                        desc='Downloading videos', total=len(tasks),
+                        position=0)
+        for url, status, msg in progress:
+            results[status] += 1
+            if status == BatchStatus.FAILED:
+                failed.append((url, msg))
+    for url, msg in failed:
+        tqdm.write(f'Unable to download {url}: {msg}')
+    tqdm.write(', '.join(f'{status.value}: {n}'
+                         for status, n in results.items()))
+    return results
+
+
 if __name__ == '__main__':
     main()